@@ -0,0 +1,72 @@
+"""
+Query Result Cache
+
+TTL cache for the hot read endpoints, holding already-serialized JSON bodies.
+Entries are keyed by user and filter, and dropped by the write endpoints that change them.
+Backed by Redis when REDIS_URL is set, so every uvicorn worker sees the same entries;
+otherwise an in-process TTLCache, which is only coherent with a single worker.
+"""
+
+import os
+import logging
+from typing import Optional
+from cachetools import TTLCache
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL_SECONDS = 60
+
+_redis = None
+_local = TTLCache(maxsize=1024, ttl=CACHE_TTL_SECONDS)
+
+
+def connect_cache():
+    """Create this process's Redis client if REDIS_URL is set; call from the app startup hook"""
+    global _redis
+    redis_url = os.getenv("REDIS_URL")
+    if _redis is None and redis_url:
+        _redis = aioredis.from_url(redis_url)
+    return _redis
+
+
+async def close_cache():
+    """Close the Redis client and its connection pool"""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+    _redis = None
+
+
+async def get_cached(key: str) -> Optional[bytes]:
+    """Return the cached body for key, or None if missing, expired or Redis is unreachable"""
+    if _redis is None:
+        return _local.get(key)
+    try:
+        return await _redis.get(key)
+    except RedisError:
+        logger.exception("Cache read failed for %s", key)
+        return None
+
+
+async def set_cached(key: str, value: bytes):
+    """Store a body for CACHE_TTL_SECONDS"""
+    if _redis is None:
+        _local[key] = value
+        return
+    try:
+        await _redis.set(key, value, ex=CACHE_TTL_SECONDS)
+    except RedisError:
+        logger.exception("Cache write failed for %s", key)
+
+
+async def invalidate(key: str):
+    """Drop a cached body after the underlying data changed"""
+    if _redis is None:
+        _local.pop(key, None)
+        return
+    try:
+        await _redis.delete(key)
+    except RedisError:
+        logger.exception("Cache invalidation failed for %s", key)
@@ -5,13 +5,17 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
 from datetime import datetime, timezone
 import os
+import logging
 from dotenv import load_dotenv
 from typing import Union
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -21,35 +25,91 @@ db = None
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
-if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+def connect_db():
+    """Create this process's Motor client; call once from the app/worker startup hook"""
+    global _client, db
+    if _client is None and database_url and database_name:
+        # Bounded, pre-warmed pool: minPoolSize opens sockets in the background so the
+        # first requests skip the handshake, maxConnecting throttles bursts of new sockets.
+        _client = AsyncIOMotorClient(
+            database_url,
+            maxPoolSize=50,
+            minPoolSize=10,
+            maxConnecting=2,
+            waitQueueTimeoutMS=2000,
+        )
+        db = _client[database_name]
+    return _client
 
-# Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+def close_db():
+    """Close the Motor client and its connection pool"""
+    global _client, db
+    if _client is not None:
+        _client.close()
+    _client = None
+    db = None
+
+def db_available() -> bool:
+    """Whether connect_db() has created a database handle"""
+    return db is not None
+
+def get_db():
+    """Return the database handle, raising if the database is not configured"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    return db
 
+# Helper functions for common database operations
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp"""
     # Convert Pydantic model to dict if needed
     if isinstance(data, BaseModel):
         data_dict = data.model_dump()
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await get_db()[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
-    if db is None:
-        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
-    cursor = db[collection_name].find(filter_dict or {})
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, projection: dict = None,
+                        batch_size: int = 500):
+    """Get documents from collection, optionally returning only the projected fields"""
+    # Larger batches than the driver default (101) mean fewer getMore round-trips
+    cursor = get_db()[collection_name].find(filter_dict or {}, projection).batch_size(batch_size)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    documents = await cursor.to_list(length=None)
+    # ObjectId is not JSON serializable; expose ids as strings
+    for doc in documents:
+        if "_id" in doc:
+            doc["_id"] = str(doc["_id"])
+    return documents
+
+# Indexes matching the filters used by the API handlers: (collection, keys, options)
+INDEXES = [
+    ("subject", [("user_id", ASCENDING)], {}),
+    ("book", [("user_id", ASCENDING), ("subject_id", ASCENDING)], {}),
+    ("book", [("content_hash", ASCENDING)], {}),
+    # Unique: one progress document per user+book pair (see README for deduplicating old data)
+    ("progress", [("user_id", ASCENDING), ("book_id", ASCENDING)], {"unique": True}),
+    ("lesson", [("user_id", ASCENDING), ("book_id", ASCENDING)], {}),
+]
+
+# Indexes whose last build attempt failed, as "collection(field_1, field_2)" -> error; shown by /test
+index_errors = {}
+
+async def ensure_indexes():
+    """Create the handler indexes, logging (not raising) any that fail to build"""
+    for collection_name, keys, options in INDEXES:
+        name = f"{collection_name}({', '.join(field for field, _ in keys)})"
+        try:
+            await get_db()[collection_name].create_index(keys, **options)
+            index_errors.pop(name, None)
+        except Exception as e:
+            index_errors[name] = str(e)[:100]
+            logger.exception("Could not create index %s", name)
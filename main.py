@@ -1,22 +1,64 @@
 import os
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends
+import asyncio
+import hashlib
+import contextlib
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
+import time
 import uuid
-
-from database import db, create_document, get_documents
-from schemas import Subject, Book, LessonRequest, Lesson, Schedule, Progress
-
-app = FastAPI()
+import aiofiles.os
+import orjson
+from pymongo import ReturnDocument, UpdateOne
+from bson import ObjectId
+from bson.errors import InvalidId
+from arq import create_pool
+from arq.connections import RedisSettings
+
+from database import connect_db, close_db, db_available, get_db, index_errors, create_document, get_documents, ensure_indexes
+from cache import connect_cache, close_cache, get_cached, set_cached, invalidate
+from schemas import Subject, Book, LessonRequest, Lesson, LessonPatch, LessonStatus, Schedule, Progress
+
+
+# When Redis is configured, lesson dispatch goes through the arq worker (worker.py)
+# and the read cache (cache.py) is shared across uvicorn workers
+REDIS_URL = os.getenv("REDIS_URL")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One Motor client per worker process, created on the running event loop
+    # Handlers and the worker reach it through database.get_db()
+    connect_db()
+    # Built in the background so an unreachable Mongo does not block or crash startup;
+    # /test reports the connection problem instead
+    index_task = asyncio.create_task(ensure_indexes()) if db_available() else None
+    connect_cache()
+    app.state.arq = await create_pool(RedisSettings.from_dsn(REDIS_URL)) if REDIS_URL else None
+    yield
+    if app.state.arq is not None:
+        await app.state.arq.close()
+    if index_task is not None and not index_task.done():
+        index_task.cancel()
+    await close_cache()
+    close_db()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Comma-separated list of frontend origins allowed to call the API with credentials
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[origin.strip() for origin in FRONTEND_URL.split(",") if origin.strip()],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PATCH"],
+    allow_headers=["X-User-Id", "Content-Type"],
+    max_age=86400,
 )
 
 
@@ -25,23 +67,35 @@ def read_root():
     return {"message": "AI Tutor Backend is running"}
 
 
+# Collection names rarely change; keep health probes off the database
+COLLECTIONS_CACHE_TTL_SECONDS = 30
+_coll_cache = {"ts": float("-inf"), "names": []}
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
         "database_url": None,
         "database_name": None,
         "connection_status": "Not Connected",
-        "collections": []
+        "collections": [],
+        "missing_indexes": {},
     }
     try:
-        if db is not None:
+        if db_available():
+            db = get_db()
             response["database"] = "✅ Connected & Working"
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()[:10]
+            if time.monotonic() - _coll_cache["ts"] >= COLLECTIONS_CACHE_TTL_SECONDS:
+                _coll_cache["names"] = (await db.list_collection_names())[:10]
+                _coll_cache["ts"] = time.monotonic()
+            response["collections"] = _coll_cache["names"]
+            # e.g. the unique progress index when duplicate rows block it
+            response["missing_indexes"] = dict(index_errors)
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:100]}"
     return response
@@ -50,53 +104,106 @@ def test_database():
 # Simple dependency to simulate authenticated user id
 # In production you'll verify Supabase JWT and extract user id
 
-def get_current_user_id(x_user_id: Optional[str] = None):
+def require_user_id(x_user_id: str = Header(...)) -> str:
     # This is a placeholder for real auth integration.
-    # Expecting frontend to send X-User-Id header from Supabase session.user.id
+    # Expecting frontend to send X-User-Id header from Supabase session.user.id;
+    # a missing header is rejected with 422 before the handler runs.
     return x_user_id
 
 
+def check_body_user_id(body_user_id: Optional[str], user_id: str):
+    # Bodies may still carry user_id, but the header is authoritative
+    if body_user_id is not None and body_user_id != user_id:
+        raise HTTPException(status_code=403, detail="Body user_id does not match X-User-Id")
+
+
+# Fields returned by the list endpoints; book page text and server paths stay in Mongo.
+SUBJECT_LIST_FIELDS = {"_id": 1, "name": 1, "description": 1}
+BOOK_LIST_FIELDS = {"_id": 1, "title": 1, "subject_id": 1, "original_filename": 1, "num_pages": 1}
+
+
+async def cached_json(key: str, load) -> Response:
+    # Listed documents are already JSON-ready (string ids, datetimes), so they are encoded
+    # once with orjson and the bytes are cached, skipping FastAPI's jsonable_encoder pass
+    body = await get_cached(key)
+    if body is None:
+        body = orjson.dumps(await load())
+        await set_cached(key, body)
+    return Response(content=body, media_type="application/json")
+
+
 # Subjects
 @app.post("/api/subjects")
-def create_subject(subject: Subject, user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        user_id = subject.user_id
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
+async def create_subject(subject: Subject, user_id: str = Depends(require_user_id)):
+    check_body_user_id(subject.user_id, user_id)
     payload = subject.model_dump()
     payload["user_id"] = user_id
-    _id = create_document("subject", payload)
+    _id = await create_document("subject", payload)
+    await invalidate(f"subjects:{user_id}")
     return {"id": _id}
 
 
 @app.get("/api/subjects")
-def list_subjects(user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
-    items = get_documents("subject", {"user_id": user_id})
-    return items
+async def list_subjects(user_id: str = Depends(require_user_id)):
+    return await cached_json(
+        f"subjects:{user_id}",
+        lambda: get_documents("subject", {"user_id": user_id}, projection=SUBJECT_LIST_FIELDS),
+    )
 
 
 # Books and PDF upload
 UPLOAD_DIR = os.path.join("uploads")
+UPLOAD_CHUNK_SIZE = 1 << 20
+PDF_MAGIC = b"%PDF-"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
+def copy_and_hash(src, dst_path: str) -> str:
+    # Runs in a worker thread: file reads/writes and sha256 release the GIL, and the
+    # event loop is not woken per chunk. Memory stays bounded at one chunk.
+    digest = hashlib.sha256()
+    with open(dst_path, "wb") as out:
+        while chunk := src.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
 @app.post("/api/books/upload")
 async def upload_book(
-    user_id: str = Form(...),
     subject_id: str = Form(...),
     file: UploadFile = File(...),
+    user_id: str = Depends(require_user_id),
 ):
-    if not file.filename.lower().endswith(".pdf"):
+    # Check the PDF signature rather than the extension, before anything is written to disk
+    if await file.read(len(PDF_MAGIC)) != PDF_MAGIC:
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
+    await file.seek(0)
 
-    book_id = str(uuid.uuid4())
-    fname = f"{book_id}-{file.filename}"
-    fpath = os.path.join(UPLOAD_DIR, fname)
+    tmp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.part")
 
-    with open(fpath, "wb") as out:
-        out.write(await file.read())
+    # Copy and hash in one worker-thread pass so identical PDFs share one content-addressed file
+    try:
+        content_hash = await asyncio.to_thread(copy_and_hash, file.file, tmp_path)
+        fpath = os.path.join(UPLOAD_DIR, f"{content_hash}.pdf")
+
+        if await aiofiles.os.path.exists(fpath):
+            await aiofiles.os.remove(tmp_path)
+        else:
+            await aiofiles.os.replace(tmp_path, fpath)
+    except BaseException:
+        # Don't leave partial .part files behind on I/O errors or a cancelled request.
+        # Plain os.remove: awaiting here could be interrupted by a second cancellation.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+    # Same PDF already uploaded to this subject: reuse the existing book
+    existing = await get_db()["book"].find_one(
+        {"content_hash": content_hash, "user_id": user_id, "subject_id": subject_id}, {"_id": 1}
+    )
+    if existing:
+        return {"id": str(existing["_id"]), "file_path": fpath}
 
     # Naive text extraction placeholder (no heavy libs). In production, use n8n to extract.
     # We'll just store metadata; extracted pages can be added later by n8n callback.
@@ -106,29 +213,28 @@ async def upload_book(
         title=file.filename.replace(".pdf", ""),
         original_filename=file.filename,
         file_path=fpath,
+        content_hash=content_hash,
         pages=None,
         num_pages=None,
     )
-    _id = create_document("book", book)
+    _id = await create_document("book", book)
+    await invalidate(f"books:{user_id}:{subject_id}")
     return {"id": _id, "file_path": fpath}
 
 
 @app.get("/api/books")
-def list_books(subject_id: str, user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
-    items = get_documents("book", {"user_id": user_id, "subject_id": subject_id})
-    return items
+async def list_books(subject_id: str, user_id: str = Depends(require_user_id)):
+    return await cached_json(
+        f"books:{user_id}:{subject_id}",
+        lambda: get_documents("book", {"user_id": user_id, "subject_id": subject_id}, projection=BOOK_LIST_FIELDS),
+    )
 
 
 # Lessons and progress tracking
-@app.post("/api/lessons")
-def request_lesson(req: LessonRequest, user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        user_id = req.user_id
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
-
+@app.post("/api/lessons", status_code=202)
+async def request_lesson(req: LessonRequest, request: Request, response: Response,
+                         user_id: str = Depends(require_user_id)):
+    check_body_user_id(req.user_id, user_id)
     lesson = Lesson(
         user_id=user_id,
         subject_id=req.subject_id,
@@ -136,50 +242,54 @@ def request_lesson(req: LessonRequest, user_id: Optional[str] = Depends(get_curr
         prompt=req.prompt,
         status="pending",
     )
-    _id = create_document("lesson", lesson)
+    _id = await create_document("lesson", lesson)
 
-    # Here you would trigger n8n workflow with the lesson id
-    # n8n will: extract the exact excerpt from the PDF, call LLM to explain with analogies,
-    # and PATCH back to /api/lessons/{id} with results. For now, we keep it pending.
+    # The worker triggers the n8n workflow, which PATCHes results back to /api/lessons/{id}.
+    # Without Redis nothing dispatches it, so report it as stored but still pending.
+    if request.app.state.arq is None:
+        response.status_code = 200
+        return {"id": _id, "status": "pending"}
+
+    try:
+        await request.app.state.arq.enqueue_job("dispatch_lesson", _id)
+    except Exception:
+        # Don't leave an undispatchable lesson behind for the client's retry to duplicate
+        await get_db()["lesson"].delete_one({"_id": ObjectId(_id)})
+        raise HTTPException(status_code=503, detail="Lesson queue unavailable, try again later")
 
     return {"id": _id, "status": "queued"}
 
 
 @app.get("/api/progress")
-def get_progress(book_id: str, user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
-    items = get_documents("progress", {"user_id": user_id, "book_id": book_id})
-    return items
+async def get_progress(book_id: str, user_id: str = Depends(require_user_id)):
+    return await cached_json(
+        f"progress:{user_id}:{book_id}",
+        lambda: get_documents("progress", {"user_id": user_id, "book_id": book_id}),
+    )
 
 
 @app.post("/api/progress")
-def upsert_progress(progress: Progress, user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        user_id = progress.user_id
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
-
-    # Simple upsert by user+book
-    existing = db["progress"].find_one({"user_id": user_id, "book_id": progress.book_id})
+async def upsert_progress(progress: Progress, user_id: str = Depends(require_user_id)):
+    check_body_user_id(progress.user_id, user_id)
+    # Atomic upsert by user+book; returns the id whether inserted or updated
     payload = progress.model_dump()
     payload["user_id"] = user_id
-    if existing:
-        db["progress"].update_one({"_id": existing["_id"]}, {"$set": {**payload, "updated_at": datetime.utcnow()}})
-        return {"id": str(existing["_id"]) }
-    else:
-        _id = create_document("progress", payload)
-        return {"id": _id}
+    now = datetime.now(timezone.utc)
+    doc = await get_db()["progress"].find_one_and_update(
+        {"user_id": user_id, "book_id": progress.book_id},
+        {"$set": {**payload, "updated_at": now}, "$setOnInsert": {"created_at": now}},
+        projection={"_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    await invalidate(f"progress:{user_id}:{progress.book_id}")
+    return {"id": str(doc["_id"])}
 
 
 # Scheduling via n8n
 @app.post("/api/schedules")
-def create_schedule(s: Schedule, user_id: Optional[str] = Depends(get_current_user_id)):
-    if not user_id:
-        user_id = s.user_id
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Missing user id")
-
+async def create_schedule(s: Schedule, user_id: str = Depends(require_user_id)):
+    check_body_user_id(s.user_id, user_id)
     payload = s.model_dump()
     payload["user_id"] = user_id
 
@@ -187,29 +297,57 @@ def create_schedule(s: Schedule, user_id: Optional[str] = Depends(get_current_us
     # Example placeholder: n8n_job_id = requests.post(N8N_URL, json=payload).json()["id"]
     payload["n8n_job_id"] = payload.get("n8n_job_id") or str(uuid.uuid4())
 
-    _id = create_document("schedule", payload)
+    _id = await create_document("schedule", payload)
     return {"id": _id, "n8n_job_id": payload["n8n_job_id"]}
 
 
 # Callback endpoints for n8n to update lesson results
-@app.patch("/api/lessons/{lesson_id}")
-def patch_lesson(lesson_id: str, status: Optional[str] = None, input_excerpt: Optional[str] = None,
-                 explanation: Optional[str] = None, analogies: Optional[List[str]] = None, error: Optional[str] = None):
-    doc = db["lesson"].find_one({"_id": {"$eq": db["lesson"].get_serializer().to_bson(lesson_id)}})
-    # Fallback if serializer not present; try string id match
-    if not doc:
-        doc = db["lesson"].find_one({"_id": lesson_id})
+def lesson_id_filter(lesson_id: str) -> dict:
+    # Lessons are stored with ObjectId keys; fall back to a plain string id match
+    try:
+        return {"_id": ObjectId(lesson_id)}
+    except InvalidId:
+        return {"_id": lesson_id}
+
+
+# Registered before /api/lessons/{lesson_id} so "bulk" is not captured as an id
+@app.patch("/api/lessons/bulk")
+async def patch_lessons_bulk(patches: List[LessonPatch]):
+    if not patches:
+        return {"ok": True, "matched": 0, "modified": 0}
 
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne(
+            lesson_id_filter(p.id),
+            {"$set": {**p.model_dump(exclude={"id"}, exclude_none=True), "updated_at": now}},
+        )
+        for p in patches
+    ]
+    result = await get_db()["lesson"].bulk_write(ops, ordered=False)
+    return {"ok": True, "matched": result.matched_count, "modified": result.modified_count}
+
+
+@app.patch("/api/lessons/{lesson_id}")
+async def patch_lesson(lesson_id: str, status: Optional[LessonStatus] = None, input_excerpt: Optional[str] = None,
+                       explanation: Optional[str] = None, analogies: Optional[List[str]] = None, error: Optional[str] = None):
     updates = {k: v for k, v in {
         "status": status,
         "input_excerpt": input_excerpt,
         "explanation": explanation,
         "analogies": analogies,
         "error": error,
-        "updated_at": datetime.utcnow(),
+        "updated_at": datetime.now(timezone.utc),
     }.items() if v is not None}
 
-    db["lesson"].update_one({"_id": doc["_id"]}, {"$set": updates})
+    doc = await get_db()["lesson"].find_one_and_update(
+        lesson_id_filter(lesson_id),
+        {"$set": updates},
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Lesson not found")
     return {"ok": True}
 
 
@@ -4,29 +4,38 @@ Database Schemas for AI Tutor
 Each Pydantic model represents a collection in MongoDB.
 Collection name is the lowercase class name.
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List, Literal, Dict, Any
 from datetime import datetime
 
+LessonStatus = Literal["pending", "processing", "complete", "error"]
+
 
 class Subject(BaseModel):
-    user_id: str = Field(..., description="Owner user id (from Supabase)")
+    model_config = ConfigDict(frozen=True)
+
+    user_id: Optional[str] = Field(None, description="Owner user id (from Supabase); must match X-User-Id if sent")
     name: str = Field(..., description="Subject name, e.g., Chemistry")
     description: Optional[str] = Field(None, description="Optional subject description")
 
 
 class Book(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     user_id: str = Field(..., description="Owner user id")
     subject_id: str = Field(..., description="Subject document id")
     title: str = Field(..., description="Book title")
     original_filename: Optional[str] = Field(None, description="Uploaded file name")
     file_path: Optional[str] = Field(None, description="Server file path of the upload")
+    content_hash: Optional[str] = Field(None, description="SHA-256 of the uploaded file contents")
     pages: Optional[List[str]] = Field(default=None, description="Extracted text per page")
     num_pages: Optional[int] = Field(default=None, description="Number of pages extracted")
 
 
 class LessonRequest(BaseModel):
-    user_id: str
+    model_config = ConfigDict(frozen=True)
+
+    user_id: Optional[str] = Field(None, description="Must match X-User-Id if sent")
     subject_id: str
     book_id: str
     prompt: str = Field(..., description="User instruction for the AI tutor, e.g., 'Explain first 50 lines of Chapter 1'")
@@ -37,12 +46,14 @@ class LessonRequest(BaseModel):
 
 
 class Lesson(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     user_id: str
     subject_id: str
     book_id: str
     request_id: Optional[str] = None
     prompt: str
-    status: Literal["pending", "processing", "complete", "error"] = "pending"
+    status: LessonStatus = "pending"
     input_excerpt: Optional[str] = None
     explanation: Optional[str] = None
     analogies: Optional[List[str]] = None
@@ -50,8 +61,21 @@ class Lesson(BaseModel):
     scheduled_at: Optional[datetime] = None
 
 
+class LessonPatch(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    id: str = Field(..., description="Lesson document id")
+    status: Optional[LessonStatus] = None
+    input_excerpt: Optional[str] = None
+    explanation: Optional[str] = None
+    analogies: Optional[List[str]] = None
+    error: Optional[str] = None
+
+
 class Schedule(BaseModel):
-    user_id: str
+    model_config = ConfigDict(frozen=True)
+
+    user_id: Optional[str] = Field(None, description="Must match X-User-Id if sent")
     subject_id: str
     book_id: str
     prompt: str
@@ -61,7 +85,9 @@ class Schedule(BaseModel):
 
 
 class Progress(BaseModel):
-    user_id: str
+    model_config = ConfigDict(frozen=True)
+
+    user_id: Optional[str] = Field(None, description="Must match X-User-Id if sent")
     subject_id: str
     book_id: str
     last_covered_page: Optional[int] = None
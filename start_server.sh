@@ -11,9 +11,25 @@ if [ ! -z "$PIDS" ]; then
   sleep 2
 fi
 
+# Find and kill arq worker processes so restarts don't stack up queue consumers
+PIDS=$(pgrep -f "arq worker.WorkerSettings")
+if [ ! -z "$PIDS" ]; then
+  echo "Killing arq worker processes: $PIDS"
+  for pid in $PIDS; do
+    kill $pid 2>/dev/null || true
+  done
+  sleep 2
+fi
+
 mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
+# Resolve REDIS_URL like the app does (environment first, then .env via python-dotenv)
+REDIS_URL=$(python -c 'import os; from dotenv import load_dotenv; load_dotenv(); print(os.getenv("REDIS_URL") or "")')
+if [ ! -z "$REDIS_URL" ]; then
+  echo "Starting lesson dispatch worker..."
+  nohup arq worker.WorkerSettings > logs/worker.log 2>&1 &
+fi
 echo "Starting FastAPI server..."
 nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
 echo "Server started in background"
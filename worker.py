@@ -0,0 +1,86 @@
+"""
+Background Worker for AI Tutor
+
+arq worker that hands queued lessons to the n8n workflow, off the API request path.
+Run with: arq worker.WorkerSettings
+"""
+
+import os
+from datetime import datetime, timezone
+
+import httpx
+from arq.connections import RedisSettings
+from bson import ObjectId
+from pymongo import ReturnDocument
+from dotenv import load_dotenv
+
+from database import connect_db, close_db, get_db
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+N8N_LESSON_WEBHOOK_URL = os.getenv("N8N_LESSON_WEBHOOK_URL")
+
+
+async def startup(ctx):
+    connect_db()
+    # One long-lived client per worker so TCP/TLS connections to n8n are reused across jobs
+    ctx["http"] = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    )
+
+
+async def shutdown(ctx):
+    await ctx["http"].aclose()
+    close_db()
+
+
+async def dispatch_lesson(ctx, lesson_id: str):
+    """Mark a pending lesson as processing and send it to n8n"""
+    # Claim the lesson before the POST: n8n may PATCH back complete/error before the
+    # webhook call returns, and that result must not be overwritten afterwards.
+    # arq delivers at least once: a retry after a cancel (restart) or crash finds the
+    # lesson already claimed as processing by the interrupted try, so accept that too.
+    claimable = ["pending", "processing"] if ctx.get("job_try", 1) > 1 else ["pending"]
+    lesson = await get_db()["lesson"].find_one_and_update(
+        {"_id": ObjectId(lesson_id), "status": {"$in": claimable}},
+        {"$set": {"status": "processing", "updated_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if lesson is None:
+        # Missing, or already completed/failed
+        return
+
+    try:
+        if not N8N_LESSON_WEBHOOK_URL:
+            raise Exception("N8N_LESSON_WEBHOOK_URL is not set; cannot dispatch lessons.")
+
+        # n8n will: extract the exact excerpt from the PDF, call LLM to explain with analogies,
+        # and PATCH back to /api/lessons/{id} with results.
+        response = await ctx["http"].post(N8N_LESSON_WEBHOOK_URL, json={
+            "lesson_id": lesson_id,
+            "user_id": lesson["user_id"],
+            "subject_id": lesson["subject_id"],
+            "book_id": lesson["book_id"],
+            "prompt": lesson["prompt"],
+        })
+        response.raise_for_status()
+    except Exception as e:
+        await get_db()["lesson"].update_one(
+            {"_id": lesson["_id"], "status": "processing"},
+            {"$set": {
+                "status": "error",
+                "error": f"Dispatch failed: {str(e)[:200]}",
+                "updated_at": datetime.now(timezone.utc),
+            }},
+        )
+        raise
+
+
+class WorkerSettings:
+    functions = [dispatch_lesson]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(REDIS_URL)